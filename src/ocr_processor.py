@@ -1,5 +1,6 @@
 # src/ocr_processor.py
 import cv2
+import numpy as np
 import pytesseract
 import json
 import os
@@ -40,7 +41,8 @@ def get_tesseract_languages():
         return ['eng']  # fallback
 
 def ocr_with_boxes(image_path, use_technical_mode=True):
-    img = cv2.imread(image_path)
+    # Accepta un path o una imatge ja descodificada (array BGR)
+    img = image_path if isinstance(image_path, np.ndarray) else cv2.imread(image_path)
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     # Millora d'imatge
     gray = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
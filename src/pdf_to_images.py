@@ -1,19 +1,119 @@
 # src/pdf_to_images.py
-from pdf2image import convert_from_path
+from concurrent.futures import ProcessPoolExecutor
+from pdf2image import convert_from_path, pdfinfo_from_path
+import multiprocessing
+import numpy as np
 import os
 import tempfile
+import threading
 
-def pdf_to_images(pdf_path, output_folder):
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+# pdfium no admet crides concurrents des de fils diferents, ni amb documents diferents
+_PDFIUM_LOCK = threading.Lock()
+
+# Pool compartit (processos "spawn", mai fork d'un procés amb torch i fils) per
+# renderitzar pàgines en paral·lel; es crea el primer cop que cal.
+# Atenció: "spawn" torna a importar el __main__ del procés pare a cada fill. Si
+# l'script principal importa torch/ultralytics a nivell de mòdul (p. ex.
+# src/pipeline.py o ai_enhanced_pipeline.py executats directament), cada procés
+# de render també els carrega; els punts d'entrada lleugers (main.py) no.
+_RENDER_POOL = None
+_RENDER_POOL_LOCK = threading.Lock()
+_RENDER_POOL_WORKERS = min(4, os.cpu_count() or 1)
+
+def _render_page(task):
+    """Renderitza una sola pàgina del PDF com a imatge PIL"""
+    pdf_path, page_index, scale = task
+    with _PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(pdf_path)
+        try:
+            return pdf[page_index].render(scale=scale).to_pil()
+        finally:
+            pdf.close()
+
+def _render_page_to_file(task):
+    """Renderitza una pàgina i la guarda com a PNG; només torna el path al procés pare"""
+    pdf_path, page_index, scale, path = task
+    _render_page((pdf_path, page_index, scale)).save(path, "PNG")
+    return path
+
+def _get_render_pool():
+    """Pool de processos compartit per tot el procés"""
+    global _RENDER_POOL
+    if _RENDER_POOL is None:
+        with _RENDER_POOL_LOCK:
+            if _RENDER_POOL is None:
+                _RENDER_POOL = ProcessPoolExecutor(
+                    max_workers=_RENDER_POOL_WORKERS,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+    return _RENDER_POOL
+
+def pdf_to_images(pdf_path, output_folder, dpi=300):
+    """
+    Rasteritza el PDF i guarda cada pàgina com a PNG. Amb pypdfium2 les pàgines
+    es renderitzen en paral·lel al pool compartit i cada procés escriu el seu
+    PNG; sense pypdfium2 s'utilitza una sola crida a pdf2image/poppler.
+    """
     os.makedirs(output_folder, exist_ok=True)
-    images = convert_from_path(pdf_path, dpi=300)  
-    image_paths = []
-    for i, image in enumerate(images):
-        path = os.path.join(output_folder, f"page_{i+1}.png")
-        image.save(path, "PNG")
-        image_paths.append(path)
-        print(f"Pàgina {i+1} guardada com a {path}")
+    
+    if pdfium is None:
+        images = convert_from_path(pdf_path, dpi=dpi)
+        image_paths = [os.path.join(output_folder, f"page_{i}.png") for i in range(1, len(images) + 1)]
+        for image, path in zip(images, image_paths):
+            image.save(path, "PNG")
+        saved_paths = image_paths
+    else:
+        page_count = _pdf_page_count(pdf_path)
+        image_paths = [os.path.join(output_folder, f"page_{i}.png") for i in range(1, page_count + 1)]
+        tasks = [(pdf_path, i, dpi / 72, path) for i, path in enumerate(image_paths)]
+        if page_count > 1:
+            saved_paths = _get_render_pool().map(_render_page_to_file, tasks)
+        else:
+            saved_paths = map(_render_page_to_file, tasks)
+    
+    for i, path in enumerate(saved_paths, 1):
+        print(f"Pàgina {i} guardada com a {path}")
     return image_paths
 
+def _pdf_page_count(pdf_path):
+    """Nombre de pàgines del PDF"""
+    if pdfium is not None:
+        with _PDFIUM_LOCK:
+            pdf = pdfium.PdfDocument(pdf_path)
+            try:
+                return len(pdf)
+            finally:
+                pdf.close()
+    return pdfinfo_from_path(pdf_path)["Pages"]
+
+def _iter_rendered_pages(pdf_path, page_count, dpi=300):
+    """Renderitza les pàgines com a imatges PIL d'una en una"""
+    for page_number in range(1, page_count + 1):
+        if pdfium is not None:
+            yield _render_page((pdf_path, page_number - 1, dpi / 72))
+        else:
+            yield convert_from_path(pdf_path, dpi=dpi, first_page=page_number, last_page=page_number)[0]
+
+def iter_pdf_pages(pdf_path, output_folder=None, dpi=300):
+    """
+    Genera els paths de les pàgines del PDF d'una en una, de manera que es pot
+    començar a processar una pàgina mentre es renderitza la següent
+    """
+    if output_folder is None:
+        output_folder = tempfile.mkdtemp(prefix="ocr_images_")
+    os.makedirs(output_folder, exist_ok=True)
+    
+    page_count = _pdf_page_count(pdf_path)
+    for page_number, image in enumerate(_iter_rendered_pages(pdf_path, page_count, dpi), 1):
+        path = os.path.join(output_folder, f"page_{page_number}.png")
+        image.save(path, "PNG")
+        yield path
+
 def convert_pdf_to_images(pdf_path, output_folder=None):
     """
     Convert PDF to images - alias for compatibility with web pipeline
@@ -24,6 +124,19 @@ def convert_pdf_to_images(pdf_path, output_folder=None):
     
     return pdf_to_images(pdf_path, output_folder)
 
+def pdf_to_tensors(pdf_path, dpi=300):
+    """
+    Rasteritza el PDF directament a arrays BGR (mateix format que cv2.imread),
+    sense escriure ni tornar a llegir PNG intermedis. Retorna un generador que
+    renderitza una pàgina cada cop, de manera que només hi ha una pàgina en
+    memòria; el PDF s'obre abans per detectar els errors immediatament.
+    """
+    page_count = _pdf_page_count(pdf_path)
+    return (
+        np.ascontiguousarray(np.asarray(image.convert("RGB"))[:, :, ::-1])
+        for image in _iter_rendered_pages(pdf_path, page_count, dpi)
+    )
+
 # Exemple d'ús
 if __name__ == "__main__":
     pdf_path = "C:\\Users\\eceballos\\OneDrive - SOME, S.A\\Desktop\\Projectes\\OCR\\data\\exemples\\6555945_003.pdf"
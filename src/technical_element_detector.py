@@ -3,10 +3,18 @@ Detector d'Elements Tècnics integrat amb YOLOv8
 Detecta cotes, toleràncies i símbols en plànols tècnics
 """
 
+import atexit
 import cv2
+import importlib.util
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
 import numpy as np
 from pathlib import Path
-from typing import List, Dict, Tuple, Optional
+from typing import Callable, List, Dict, Tuple, Optional
 from loguru import logger
 import json
 from datetime import datetime
@@ -23,6 +31,129 @@ except ImportError:
     from .ai_model.model_manager import ModelManager
 
 
+def _cuda_available() -> bool:
+    """Comprova si hi ha una GPU CUDA disponible per a la inferència"""
+    try:
+        import torch
+        return torch.cuda.is_available()
+    except ImportError:
+        return False
+
+
+def _export_complete(export_path: Path) -> bool:
+    """Comprova que una exportació existent és completa (i no les restes d'un intent interromput)"""
+    if export_path.is_dir():
+        return (export_path / "metadata.yaml").is_file() and any(
+            xml.with_suffix(".bin").is_file() for xml in export_path.glob("*.xml")
+        )
+    return export_path.is_file() and export_path.stat().st_size > 0
+
+
+def _export_atomically(model_path: Path, export_path: Path, export_args: Dict,
+                       validate: Optional[Callable[[Path, Path], bool]] = None) -> None:
+    """
+    Exporta el model en un directori temporal i el mou al seu lloc amb un
+    rename atòmic. Un file lock evita que diversos workers exportin alhora:
+    els que esperen troben l'exportació ja feta. Si es dona ``validate``
+    (pesos originals, exportació) i retorna False, l'exportació es descarta.
+    """
+    from filelock import FileLock
+    
+    with FileLock(f"{export_path}.lock"):
+        if _export_complete(export_path):
+            return
+        
+        tmp_dir = Path(tempfile.mkdtemp(prefix=f".{model_path.stem}_export_", dir=model_path.parent))
+        try:
+            tmp_model = tmp_dir / model_path.name
+            shutil.copy2(model_path, tmp_model)
+            logger.info(f"⚙️ Exportant el model ({export_args['format']}): {export_path}")
+            exported = Path(YOLO(str(tmp_model)).export(**export_args))
+            if validate is not None and not validate(tmp_model, exported):
+                raise RuntimeError(f"L'exportació {export_args['format']} no supera la validació")
+            
+            # Restes d'una exportació interrompuda anterior
+            if export_path.is_dir():
+                shutil.rmtree(export_path)
+            elif export_path.exists():
+                export_path.unlink()
+            os.replace(exported, export_path)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+# Dataset de calibratge per a la quantització INT8: el seu split 'val' és una
+# llista explícita de les 14 imatges de data/training/images/train (sense les
+# sortides anotades del detector de images/train/annotated/)
+_CALIBRATION_DATA = Path(__file__).resolve().parents[1] / "data" / "training" / "calibration_dataset.yaml"
+_CALIBRATION_LIST = _CALIBRATION_DATA.parent / "calibration_images.txt"
+
+# Fracció mínima de deteccions del model FP32 que ha de conservar el model INT8
+_INT8_MIN_RECALL = 0.9
+
+
+def _int8_within_tolerance(fp32_weights: Path, int8_weights: Path) -> bool:
+    """Compara el nombre de deteccions INT8 i FP32 sobre les imatges de calibratge"""
+    images = [
+        str(_CALIBRATION_LIST.parent / line.strip())
+        for line in _CALIBRATION_LIST.read_text(encoding="utf-8").splitlines()
+        if line.strip()
+    ]
+    if not images:
+        logger.warning("No hi ha imatges per validar el model INT8")
+        return False
+    
+    def count_detections(model) -> int:
+        return sum(len(result.boxes) for result in model(images, conf=0.5, verbose=False, stream=True))
+    
+    fp32_count = count_detections(YOLO(str(fp32_weights)))
+    int8_count = count_detections(YOLO(str(int8_weights), task="detect"))
+    logger.info(f"📏 Validació INT8: {int8_count} deteccions vs {fp32_count} en FP32")
+    return int8_count >= _INT8_MIN_RECALL * fp32_count
+
+# Escriptura de les imatges anotades en un fil de fons (la codificació PNG és el pas més lent)
+_PNG_WRITE_PARAMS = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+_WRITE_QUEUE: "queue.Queue[Tuple[str, np.ndarray]]" = queue.Queue(maxsize=8)
+_WRITER_THREAD: Optional[threading.Thread] = None
+_WRITER_LOCK = threading.Lock()
+
+
+def _annotated_writer() -> None:
+    """Consumeix la cua i escriu les imatges anotades a disc"""
+    while True:
+        path, image = _WRITE_QUEUE.get()
+        try:
+            params = _PNG_WRITE_PARAMS if path.lower().endswith(".png") else []
+            if not cv2.imwrite(path, image, params):
+                logger.error(f"No s'ha pogut escriure la imatge anotada: {path}")
+        except Exception as e:
+            logger.error(f"Error escrivint imatge anotada {path}: {e}")
+        finally:
+            _WRITE_QUEUE.task_done()
+
+
+def _enqueue_annotated_image(path: str, image: np.ndarray) -> None:
+    """Posa una imatge anotada a la cua d'escriptura, engegant el fil si cal"""
+    global _WRITER_THREAD
+    if _WRITER_THREAD is None:
+        with _WRITER_LOCK:
+            if _WRITER_THREAD is None:
+                _WRITER_THREAD = threading.Thread(
+                    target=_annotated_writer, name="annotated-writer", daemon=True
+                )
+                _WRITER_THREAD.start()
+    _WRITE_QUEUE.put((path, image))
+
+
+def flush_annotated_images() -> None:
+    """Espera que totes les imatges anotades pendents s'hagin escrit a disc"""
+    if _WRITER_THREAD is not None:
+        _WRITE_QUEUE.join()
+
+
+atexit.register(flush_annotated_images)
+
+
 class TechnicalElementDetector:
     """Detector d'elements tècnics utilitzant YOLOv8 personalitzat"""
     
@@ -39,11 +170,19 @@ class TechnicalElementDetector:
         self.class_names = ["cota", "tolerancia", "simbol"]
         self.confidence_threshold = 0.5
         self.iou_threshold = 0.45
+        # Els models d'Ultralytics no són thread-safe: una inferència alhora per detector
+        self._inference_lock = threading.Lock()
         
         self._load_model()
     
-    def _load_model(self) -> bool:
-        """Carrega el model YOLOv8 personalitzat"""
+    def _load_model(self, offline_export: bool = False) -> bool:
+        """
+        Carrega el model YOLOv8 personalitzat
+        
+        Args:
+            offline_export: Si generar les exportacions lentes (TensorRT, INT8) quan falten
+                (pas explícit, fora del servidor)
+        """
         try:
             if YOLO is None:
                 logger.error("YOLO no disponible")
@@ -60,22 +199,102 @@ class TechnicalElementDetector:
                 logger.error(f"Fitxer del model no trobat: {model_path}")
                 return False
             
-            # Carregar el model YOLOv8
-            self.model = YOLO(model_path)
-            logger.info(f"✅ Model '{self.model_name}' carregat des de: {model_path}")
+            # Carregar el model YOLOv8 (en el format més ràpid pel maquinari disponible)
+            weights_path, task = self._resolve_runtime_weights(Path(model_path), offline_export)
+            self.model = YOLO(weights_path, task=task)
+            logger.info(f"✅ Model '{self.model_name}' carregat des de: {weights_path}")
             return True
             
         except Exception as e:
             logger.error(f"Error carregant el model: {e}")
             return False
     
-    def detect_elements(self, image_path: str, save_annotated: bool = True) -> Dict:
+    def _resolve_runtime_weights(self, model_path: Path,
+                                 offline_export: bool = False) -> Tuple[str, Optional[str]]:
+        """
+        Tria els pesos a carregar segons el maquinari
+        
+        Amb CUDA s'utilitza un motor TensorRT FP16 (``<nom>.engine``). Sense GPU,
+        l'exportació OpenVINO (``<nom>_dynamic_openvino_model/``), o abans la
+        quantitzada INT8 (``<nom>_int8_dynamic_openvino_model/``) si
+        ``OCR_DETECTOR_PRECISION=int8``. Totes tenen batch dinàmic i admeten lots
+        de fins a 8 imatges (``detect_elements_batch``).
+        
+        L'OpenVINO FP32 s'exporta sota demanda. El motor TensorRT (pot trigar més
+        que el timeout dels workers) i l'INT8 (calibratge NNCF i validació contra
+        FP32) només es generen amb ``offline_export`` (``--export`` a la línia
+        d'ordres); mentre no existeixen es passa a l'opció següent. Les
+        exportacions s'escriuen en un directori temporal i es mouen al seu lloc de
+        manera atòmica. Si no n'hi ha cap de disponible es carrega el ``.pt``.
+        
+        Returns:
+            Tuple (path dels pesos, tasca per YOLO o None si és un .pt)
+        """
+        # (path, runtime, arguments d'export, validació, només fora de línia)
+        if _cuda_available():
+            candidates = [
+                (model_path.with_suffix(".engine"), "tensorrt",
+                 {"format": "engine", "half": True, "imgsz": 640,
+                  "batch": 8, "dynamic": True, "workspace": 4}, None, True)
+            ]
+        else:
+            candidates = []
+            if os.environ.get("OCR_DETECTOR_PRECISION", "").lower() == "int8":
+                candidates.append(
+                    (model_path.with_name(f"{model_path.stem}_int8_dynamic_openvino_model"), "nncf",
+                     {"format": "openvino", "imgsz": 640, "int8": True, "batch": 8,
+                      "dynamic": True, "data": str(_CALIBRATION_DATA)},
+                     _int8_within_tolerance, True)
+                )
+            candidates.append(
+                (model_path.with_name(f"{model_path.stem}_dynamic_openvino_model"), "openvino",
+                 {"format": "openvino", "imgsz": 640, "half": False,
+                  "batch": 8, "dynamic": True}, None, False)
+            )
+        
+        for export_path, runtime, export_args, validate, offline_only in candidates:
+            if _export_complete(export_path):
+                return str(export_path), "detect"
+            if importlib.util.find_spec(runtime) is None:
+                continue
+            if offline_only and not offline_export:
+                logger.warning(
+                    f"Exportació no trobada ({export_path.name}). "
+                    "Genera-la amb: python src/technical_element_detector.py --export"
+                )
+                continue
+            try:
+                _export_atomically(model_path, export_path, export_args, validate)
+                return str(export_path), "detect"
+            except Exception as e:
+                logger.warning(f"No s'ha pogut exportar el model ({export_path.name}): {e}")
+        
+        return str(model_path), None
+    
+    def export_runtime_weights(self) -> bool:
+        """Genera l'exportació pel maquinari actual (inclosos TensorRT i INT8) i la carrega"""
+        return self._load_model(offline_export=True)
+    
+    def warmup(self, imgsz: int = 640) -> None:
+        """Executa una inferència amb una imatge buida per inicialitzar el runtime (CUDA, kernels)"""
+        if not self.model:
+            return
+        try:
+            with self._inference_lock:
+                self.model(np.zeros((imgsz, imgsz, 3), dtype=np.uint8), verbose=False)
+            logger.info("🔥 Model escalfat")
+        except Exception as e:
+            logger.warning(f"Error escalfant el model: {e}")
+    
+    def detect_elements(self, image_path, save_annotated: bool = True,
+                        conf: Optional[float] = None) -> Dict:
         """
         Detecta elements tècnics en una imatge
         
         Args:
-            image_path: Path a la imatge a processar
-            save_annotated: Si guardar la imatge amb anotacions
+            image_path: Path a la imatge a processar o imatge ja descodificada (array BGR)
+            save_annotated: Si guardar la imatge amb anotacions (només per paths)
+            conf: Llindar de confiança per aquesta crida (per defecte, el del detector)
             
         Returns:
             Dict amb els resultats de la detecció
@@ -84,74 +303,145 @@ class TechnicalElementDetector:
             logger.error("Model no carregat")
             return {"error": "Model no disponible"}
         
+        if conf is None:
+            conf = self.confidence_threshold
+        
         try:
-            # Carregar imatge
-            image_path = Path(image_path)
-            if not image_path.exists():
-                logger.error(f"Imatge no trobada: {image_path}")
-                return {"error": f"Imatge no trobada: {image_path}"}
+            if isinstance(image_path, np.ndarray):
+                # Imatge ja en memòria: no cal llegir-la de disc
+                source = image_path
+                image_ref = image_name = "imatge en memòria"
+                save_annotated = False
+            else:
+                # Carregar imatge
+                image_path = Path(image_path)
+                if not image_path.exists():
+                    logger.error(f"Imatge no trobada: {image_path}")
+                    return {"error": f"Imatge no trobada: {image_path}"}
+                source = image_ref = str(image_path)
+                image_name = image_path.name
             
             # Executar detecció
-            results = self.model(
-                str(image_path),
-                conf=self.confidence_threshold,
-                iou=self.iou_threshold,
-                save=False,
-                verbose=False
-            )
+            with self._inference_lock:
+                results = self.model(
+                    source,
+                    conf=conf,
+                    iou=self.iou_threshold,
+                    save=False,
+                    verbose=False
+                )
             
             # Processar resultats
-            detections = self._process_results(results[0], str(image_path))
+            detections = self._process_results(results[0], image_ref, conf)
             
             # Guardar imatge anotada si es demana
             if save_annotated and detections['elements']:
                 annotated_path = self._save_annotated_image(
-                    str(image_path), 
+                    source, 
                     results[0], 
                     detections
                 )
                 detections['annotated_image'] = annotated_path
             
-            logger.info(f"🔍 Detectats {len(detections['elements'])} elements a {image_path.name}")
+            logger.info(f"🔍 Detectats {len(detections['elements'])} elements a {image_name}")
             return detections
             
         except Exception as e:
             logger.error(f"Error en la detecció: {e}")
             return {"error": str(e)}
     
-    def _process_results(self, result, image_path: str) -> Dict:
+    def detect_elements_batch(self, image_paths: List[str], batch_size: int = 8,
+                              conf: Optional[float] = None,
+                              save_annotated: bool = False) -> List[Dict]:
+        """
+        Detecta elements tècnics en diverses imatges amb inferència per lots
+        
+        Args:
+            image_paths: Paths de les imatges a processar
+            batch_size: Nombre d'imatges per lot enviat al model
+            conf: Llindar de confiança per aquesta crida (per defecte, el del detector)
+            save_annotated: Si guardar les imatges amb anotacions
+            
+        Returns:
+            Llista amb un resultat per imatge (mateix format que detect_elements)
+        """
+        if not self.model:
+            logger.error("Model no carregat")
+            return [{"error": "Model no disponible"} for _ in image_paths]
+        
+        if not image_paths:
+            return []
+        
+        if conf is None:
+            conf = self.confidence_threshold
+        
+        try:
+            sources = [str(image_path) for image_path in image_paths]
+            detections = []
+            # stream=True: els Results (amb la imatge original a resolució completa)
+            # es processen i s'alliberen d'un en un en lloc de retenir-los tots
+            with self._inference_lock:
+                results = self.model(
+                    sources,
+                    conf=conf,
+                    iou=self.iou_threshold,
+                    batch=batch_size,
+                    save=False,
+                    verbose=False,
+                    stream=True
+                )
+                for result, source in zip(results, sources):
+                    detection = self._process_results(result, source, conf)
+                    if save_annotated and detection['elements']:
+                        detection['annotated_image'] = self._save_annotated_image(source, result, detection)
+                    detections.append(detection)
+            
+            total = sum(len(detection['elements']) for detection in detections)
+            logger.info(f"🔍 Detectats {total} elements a {len(sources)} imatges")
+            return detections
+            
+        except Exception as e:
+            logger.error(f"Error en la detecció per lots: {e}")
+            return [{"error": str(e)} for _ in image_paths]
+    
+    def _process_results(self, result, image_path: str, conf_threshold: float) -> Dict:
         """Processa els resultats de YOLO en un format estructurat"""
         elements = []
         summary = {"cota": 0, "tolerancia": 0, "simbol": 0}
         
-        if result.boxes is not None:
-            boxes = result.boxes.xyxy.cpu().numpy()  # Coordenades x1, y1, x2, y2
-            confidences = result.boxes.conf.cpu().numpy()
-            classes = result.boxes.cls.cpu().numpy()
+        if result.boxes is not None and len(result.boxes):
+            # Una sola còpia a CPU i tota l'aritmètica de caixes vectoritzada
+            boxes = result.boxes.xyxy.cpu().numpy().astype(np.float64)  # Coordenades x1, y1, x2, y2
+            scores = result.boxes.conf.cpu().numpy().astype(np.float64)
+            classes = result.boxes.cls.cpu().numpy().astype(np.int64)
             
-            for i, (box, conf, cls) in enumerate(zip(boxes, confidences, classes)):
-                class_name = self.class_names[int(cls)]
-                
-                element = {
+            sizes = boxes[:, 2:] - boxes[:, :2]
+            centers = (boxes[:, :2] + boxes[:, 2:]) / 2
+            
+            class_counts = np.bincount(classes, minlength=len(self.class_names))
+            for class_name, count in zip(self.class_names, class_counts.tolist()):
+                summary[class_name] = count
+            
+            rows = zip(boxes.tolist(), sizes.tolist(), centers.tolist(), scores.tolist(), classes.tolist())
+            for i, ((x1, y1, x2, y2), (width, height), (cx, cy), score, cls) in enumerate(rows):
+                class_name = self.class_names[cls]
+                elements.append({
                     "id": f"{class_name}_{i+1}",
                     "type": class_name,
-                    "confidence": float(conf),
+                    "confidence": score,
                     "bbox": {
-                        "x1": float(box[0]),
-                        "y1": float(box[1]),
-                        "x2": float(box[2]),
-                        "y2": float(box[3]),
-                        "width": float(box[2] - box[0]),
-                        "height": float(box[3] - box[1])
+                        "x1": x1,
+                        "y1": y1,
+                        "x2": x2,
+                        "y2": y2,
+                        "width": width,
+                        "height": height
                     },
                     "center": {
-                        "x": float((box[0] + box[2]) / 2),
-                        "y": float((box[1] + box[3]) / 2)
+                        "x": cx,
+                        "y": cy
                     }
-                }
-                
-                elements.append(element)
-                summary[class_name] += 1
+                })
         
         return {
             "image_path": image_path,
@@ -161,7 +451,7 @@ class TechnicalElementDetector:
             "summary": summary,
             "elements": elements,
             "detection_params": {
-                "confidence_threshold": self.confidence_threshold,
+                "confidence_threshold": conf_threshold,
                 "iou_threshold": self.iou_threshold
             }
         }
@@ -222,8 +512,8 @@ class TechnicalElementDetector:
             annotated_path = image_path_obj.parent / "annotated" / f"detected_{image_path_obj.name}"
             annotated_path.parent.mkdir(exist_ok=True)
             
-            cv2.imwrite(str(annotated_path), image)
-            logger.info(f"💾 Imatge anotada guardada: {annotated_path}")
+            _enqueue_annotated_image(str(annotated_path), image)
+            logger.info(f"💾 Imatge anotada en cua per guardar: {annotated_path}")
             
             return str(annotated_path)
             
@@ -278,13 +568,31 @@ class TechnicalElementDetector:
             }
         }
         
-        # Processar cada imatge
-        for i, image_file in enumerate(image_files, 1):
-            logger.info(f"📷 Processant {i}/{len(image_files)}: {image_file.name}")
+        # Processar les imatges per lots perquè el model faci inferència batched
+        batch_size = 8
+        for start in range(0, len(image_files), batch_size):
+            batch_files = image_files[start:start + batch_size]
+            logger.info(f"📷 Processant {start + 1}-{start + len(batch_files)}/{len(image_files)}")
+            
+            batch_results = self.detect_elements_batch(
+                [str(image_file) for image_file in batch_files],
+                batch_size=batch_size,
+                save_annotated=True
+            )
             
-            detection_result = self.detect_elements(str(image_file), save_annotated=True)
+            # Si el lot falla (p. ex. una imatge il·legible), processar-lo imatge a imatge
+            # perquè només es descartin les imatges que realment fallen
+            if any("error" in detection_result for detection_result in batch_results):
+                logger.warning("⚠️ El lot ha fallat, es processa imatge a imatge")
+                batch_results = [
+                    self.detect_elements(str(image_file), save_annotated=True)
+                    for image_file in batch_files
+                ]
             
-            if "error" not in detection_result:
+            for image_file, detection_result in zip(batch_files, batch_results):
+                if "error" in detection_result:
+                    continue
+                
                 all_results["results"].append(detection_result)
                 
                 # Actualitzar resum
@@ -295,6 +603,9 @@ class TechnicalElementDetector:
                 
                 all_results["summary"]["by_image"][image_file.name] = detection_result["total_elements"]
         
+        # Assegurar que les imatges anotades ja són a disc abans de retornar
+        flush_annotated_images()
+        
         # Guardar resultats en JSON
         results_file = output_path / f"detection_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
         with open(results_file, 'w', encoding='utf-8') as f:
@@ -317,16 +628,27 @@ def main():
     import argparse
     
     parser = argparse.ArgumentParser(description="Detector d'Elements Tècnics YOLOv8")
-    parser.add_argument("--input", required=True, help="Imatge o directori d'entrada")
+    parser.add_argument("--input", help="Imatge o directori d'entrada")
+    parser.add_argument("--export", action="store_true",
+                        help="Genera l'exportació del model pel maquinari actual (TensorRT/OpenVINO)")
     parser.add_argument("--output", help="Directori de sortida")
     parser.add_argument("--confidence", type=float, default=0.5, help="Llindar de confiança")
     parser.add_argument("--iou", type=float, default=0.45, help="Llindar IoU")
     parser.add_argument("--model", default="technical_detector", help="Nom del model")
     
     args = parser.parse_args()
+    if not args.export and not args.input:
+        parser.error("cal --input o --export")
     
     # Crear detector
     detector = TechnicalElementDetector(model_name=args.model)
+    
+    if args.export:
+        if not detector.export_runtime_weights():
+            sys.exit(1)
+        if not args.input:
+            return
+    
     detector.set_thresholds(args.confidence, args.iou)
     
     input_path = Path(args.input)
@@ -8,6 +8,7 @@ import os
 import json
 import time
 import sys
+import signal
 import logging
 from pathlib import Path
 
@@ -19,8 +20,30 @@ from flask import Flask, render_template, request, jsonify, send_file
 from werkzeug.utils import secure_filename
 from werkzeug.exceptions import RequestEntityTooLarge
 
+try:
+    import orjson
+    from flask.json.provider import DefaultJSONProvider
+except ImportError:
+    orjson = None
+else:
+    class OrjsonProvider(DefaultJSONProvider):
+        """Proveïdor JSON basat en orjson per respostes OCR grans"""
+        
+        def dumps(self, obj, **kwargs):
+            option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+            if self.sort_keys:
+                option |= orjson.OPT_SORT_KEYS
+            return orjson.dumps(obj, default=self.default, option=option).decode('utf-8')
+        
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+
 app = Flask(__name__)
 
+# Use orjson for jsonify responses when available (serializes NumPy arrays natively)
+if orjson is not None:
+    app.json = OrjsonProvider(app)
+
 # Configuration
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 app.config['UPLOAD_FOLDER'] = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'data', 'uploads'))
@@ -42,6 +65,11 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# The log format above uses no thread/process/source info, so skip collecting it per record
+logging.logThreads = False
+logging.logProcesses = False
+logging._srcfile = None
+
 # Allowed file extensions
 ALLOWED_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg', 'tiff', 'bmp', 'gif'}
 
@@ -678,18 +706,115 @@ def too_large(e):
         'error': 'Fitxer massa gran. Mida màxima: 16MB'
     }), 413
 
+# Rendered index page, cached on first use so 404s don't re-render the template
+_INDEX_HTML = None
+
 @app.errorhandler(404)
 def not_found(e):
+    global _INDEX_HTML
     if request.path.startswith('/api/') or request.path.startswith('/upload'):
         return jsonify({'error': 'Endpoint no trobat'}), 404
-    return render_template('index.html')  # Serve the main app for any other 404
+    if _INDEX_HTML is None:
+        _INDEX_HTML = render_template('index.html')
+    return _INDEX_HTML  # Serve the main app for any other 404
 
 @app.errorhandler(500)
 def internal_error(e):
     logger.error(f"Internal server error: {str(e)}")
     return jsonify({'error': 'Error intern del servidor'}), 500
 
-if __name__ == '__main__':
+def _handle_sigterm(signum, frame):
+    """Atura el servidor de manera ordenada i buida els logs pendents"""
+    logger.info("SIGTERM received - shutting down OCR application")
+    logging.shutdown()
+    sys.exit(0)
+
+def _limit_worker_threads(threads: int):
+    """
+    Limita els fils de càlcul del worker (torch, OpenMP, Tesseract): per defecte
+    cada runtime fa servir tots els nuclis, i amb un worker per nucli serien
+    ~nuclis² fils. S'ha de cridar abans de carregar el model.
+    """
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    os.environ['OMP_THREAD_LIMIT'] = str(threads)  # Tesseract (OpenMP)
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+
+def _warmup_worker(server, worker):
+    """
+    Carrega i escalfa el pipeline a cada worker, després del fork: el master no
+    toca CUDA (no sobreviu a un fork) ni els pesos del model
+    """
+    _limit_worker_threads(max(1, (os.cpu_count() or 1) // server.cfg.workers))
+    try:
+        from direct_pipeline import create_direct_pipeline
+        pipeline = create_direct_pipeline()
+        if pipeline is not None and pipeline.yolo_detector is not None:
+            pipeline.yolo_detector.warmup()
+    except Exception as e:
+        logger.warning(f"Could not warm up OCR pipeline: {e}")
+
+def run_server(host='0.0.0.0', port=5000):
+    """
+    Arrenca l'aplicació amb gunicorn (pre-fork, un worker per nucli, o
+    OCR_WORKERS). Cada worker limita els seus fils de càlcul a nuclis/workers i
+    carrega el pipeline al hook post_fork.
+    
+    Punt d'entrada: ``python src/ui/app_production.py`` (posa src/ui al
+    sys.path, d'on s'importa direct_pipeline). Cridar ``gunicorn`` directament
+    amb ``src.ui.app_production:app`` no configura el hook ni el path i
+    l'aplicació acabaria en mode simulació.
+    
+    Si gunicorn no està disponible (p. ex. a Windows) s'utilitza el servidor
+    integrat de Flask.
+    """
+    workers = int(os.environ.get('OCR_WORKERS', os.cpu_count() or 1))
+    
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        logger.warning("gunicorn not available - falling back to Flask built-in server")
+        signal.signal(signal.SIGTERM, _handle_sigterm)
+        app.run(
+            debug=False,  # Set to False for production
+            host=host,
+            port=port,
+            threaded=True,
+            use_reloader=False  # Disable reloader for stability
+        )
+        return
+    
+    class OCRApplication(BaseApplication):
+        def __init__(self, application, options):
+            self.application = application
+            self.options = options
+            super().__init__()
+        
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+        
+        def load(self):
+            return self.application
+    
+    options = {
+        'bind': f'{host}:{port}',
+        'workers': workers,
+        'worker_class': 'gthread',
+        'threads': 2,
+        'timeout': 300,
+        'graceful_timeout': 60,
+        'preload_app': True,
+        'post_fork': _warmup_worker
+    }
+    logger.info(f"Starting gunicorn with {workers} workers")
+    OCRApplication(app, options).run()
+
+def main():
+    """Punt d'entrada de l'aplicació de producció"""
     print("=" * 60)
     print("🚀 STARTING OCR PRODUCTION WEB APPLICATION")
     print("=" * 60)
@@ -707,14 +832,11 @@ if __name__ == '__main__':
     print("=" * 60)
     
     try:
-        app.run(
-            debug=False,  # Set to False for production
-            host='0.0.0.0',
-            port=5000,
-            threaded=True,
-            use_reloader=False  # Disable reloader for stability
-        )
+        run_server()
     except Exception as e:
         logger.error(f"Failed to start application: {str(e)}")
         print(f"❌ Failed to start application: {str(e)}")
         sys.exit(1)
+
+if __name__ == '__main__':
+    main()
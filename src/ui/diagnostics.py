@@ -6,45 +6,77 @@ Script per diagnosticar problemes amb l'aplicació OCR
 import os
 import sys
 import logging
+import importlib
+import importlib.util
+from importlib import metadata
 from pathlib import Path
+from typing import Dict, Optional
 
 # Configurar logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# Resultats de les comprovacions de mòduls (nom del mòdul -> disponible)
+_DEP_CACHE: Dict[str, bool] = {}
+
+def _module_available(module_name: str) -> bool:
+    """Comprova si un mòdul es pot importar sense importar-lo realment"""
+    if module_name not in _DEP_CACHE:
+        try:
+            _DEP_CACHE[module_name] = importlib.util.find_spec(module_name) is not None
+        except (ImportError, ValueError):
+            _DEP_CACHE[module_name] = False
+    return _DEP_CACHE[module_name]
+
+def _project_module_error(module_name: str) -> Optional[Exception]:
+    """Importa realment un mòdul del projecte; retorna l'error si les seves dependències fallen"""
+    try:
+        importlib.import_module(module_name)
+        return None
+    except Exception as e:
+        return e
+
+def _package_version(distribution: str) -> str:
+    """Obté la versió instal·lada d'un paquet a partir de les metadades"""
+    try:
+        return metadata.version(distribution)
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
 def check_dependencies():
     """Comprova si tots els mòduls necessaris estan disponibles"""
     logger.info("Checking dependencies...")
     
-    try:
-        import flask
-        logger.info(f"✅ Flask disponible (v{flask.__version__})")
-    except ImportError:
+    if _module_available("flask"):
+        logger.info(f"✅ Flask disponible (v{_package_version('flask')})")
+    else:
         logger.error("❌ Flask no disponible")
         return False
     
-    try:
-        import werkzeug
-        logger.info(f"✅ Werkzeug disponible (v{werkzeug.__version__})")
-    except ImportError:
+    if _module_available("werkzeug"):
+        logger.info(f"✅ Werkzeug disponible (v{_package_version('werkzeug')})")
+    else:
         logger.error("❌ Werkzeug no disponible")
         return False
     
     # Check OCR modules
-    project_root = Path(__file__).parent.parent
-    sys.path.insert(0, str(project_root))
-    
-    try:
-        from src.ocr_processor import OCRProcessor
-        logger.info("✅ OCRProcessor disponible")
-    except ImportError as e:
-        logger.warning(f"⚠️ OCRProcessor no disponible: {e}")
+    project_root = str(Path(__file__).parent.parent)
+    if project_root not in sys.path:
+        sys.path.insert(0, project_root)
+    
+    # Els mòduls del projecte s'importen de debò: find_spec no detectaria que
+    # falta pytesseract, cv2 o pdf2image
+    error = _project_module_error("src.ocr_processor")
+    if error is None:
+        logger.info("✅ OCR processor disponible")
+    else:
+        logger.warning(f"⚠️ OCR processor no disponible: {error}")
     
-    try:
-        from src.pdf_to_images import convert_pdf_to_images
+    error = _project_module_error("src.pdf_to_images")
+    if error is None:
         logger.info("✅ PDF to images disponible")
-    except ImportError as e:
-        logger.warning(f"⚠️ PDF to images no disponible: {e}")
+    else:
+        logger.warning(f"⚠️ PDF to images no disponible: {error}")
     
     return True
 
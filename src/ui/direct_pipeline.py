@@ -9,8 +9,12 @@ import sys
 import json
 import time
 import logging
+import threading
+from collections import Counter
 from pathlib import Path
-from typing import Dict, List, Any, Optional
+from typing import Dict, Iterable, List, Any, Optional, Union
+
+import numpy as np
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -74,53 +78,59 @@ class DirectWebPipeline:
         }
         
         try:
-            # Convert PDF to image if needed
-            image_paths = self._prepare_images(file_path)
+            # Convert PDF to image arrays if needed
+            images = self._prepare_images(file_path)
             
             all_text = []
             all_confidences = []
             all_detections = []
             
-            for image_path in image_paths:
+            for page_number, image in enumerate(images, 1):
+                page_label = image if isinstance(image, str) else f"page {page_number}"
+                
                 # Process with OCR
                 if self.ocr_available and self.ocr_function:
                     try:
-                        ocr_data, img_shape = self.ocr_function(image_path)
-                        # Extract text and confidence
-                        page_text = ' '.join([item['text'] for item in ocr_data if item['text'].strip()])
-                        page_confidence = sum([item['confidence'] for item in ocr_data]) / len(ocr_data) if ocr_data else 0
+                        ocr_data, img_shape = self.ocr_function(image)
+                        # Extract text and confidence in a single pass
+                        texts = []
+                        confidences = []
+                        for item in ocr_data:
+                            text = item['text']
+                            if text.strip():
+                                texts.append(text)
+                            confidences.append(item['confidence'])
                         
-                        all_text.append(page_text)
-                        all_confidences.append(page_confidence)
+                        if texts:
+                            all_text.append(' '.join(texts))
+                        all_confidences.append(np.asarray(confidences, dtype=np.float64))
                         
-                        logger.info(f"OCR processed {len(ocr_data)} text elements from {image_path}")
+                        logger.info("OCR processed %d text elements from %s", len(ocr_data), page_label)
                     except Exception as e:
-                        logger.error(f"OCR processing error: {e}")
+                        logger.error("OCR processing error: %s", e)
                 
                 # Process with YOLOv8
                 if self.yolo_available and self.yolo_detector:
                     try:
-                        # Set confidence threshold on the detector instance
-                        original_threshold = self.yolo_detector.confidence_threshold
                         confidence_threshold = options.get('yolo_confidence', 0.3)
-                        self.yolo_detector.confidence_threshold = confidence_threshold
-                        
-                        detections = self.yolo_detector.detect_elements(image_path)
-                        
-                        # Restore original threshold
-                        self.yolo_detector.confidence_threshold = original_threshold
+                        detections = self.yolo_detector.detect_elements(
+                            image,
+                            conf=confidence_threshold
+                        )
                         
                         if 'elements' in detections:
                             all_detections.extend(detections['elements'])
-                            logger.info(f"YOLOv8 detected {len(detections['elements'])} elements from {image_path}")
+                            logger.info("YOLOv8 detected %d elements from %s", len(detections['elements']), page_label)
                         else:
-                            logger.info(f"YOLOv8 processed {image_path} but found no elements")
+                            logger.info("YOLOv8 processed %s but found no elements", page_label)
                     except Exception as e:
-                        logger.error(f"YOLOv8 processing error: {e}")
+                        logger.error("YOLOv8 processing error: %s", e)
             
             # Combine results
-            result['ocr_text'] = '\n\n'.join(filter(None, all_text))
-            result['ocr_confidence'] = sum(all_confidences) / len(all_confidences) if all_confidences else 0
+            result['ocr_text'] = '\n\n'.join(all_text)
+            # Mitjana ponderada per nombre d'elements, no mitjana de mitjanes per pàgina
+            confidences = np.concatenate(all_confidences) if all_confidences else np.empty(0)
+            result['ocr_confidence'] = float(confidences.mean(dtype=np.float64)) if confidences.size else 0
             result['yolo_detections'] = all_detections
             result['technical_elements'] = self._format_technical_elements(all_detections)
             result['combined_analysis'] = self._analyze_combined_results(result)
@@ -133,17 +143,14 @@ class DirectWebPipeline:
         
         return result
     
-    def _prepare_images(self, file_path: str) -> List[str]:
-        """Preparar imatges per processar"""
-        import os
+    def _prepare_images(self, file_path: str) -> Iterable[Union[str, np.ndarray]]:
+        """Preparar imatges per processar (arrays BGR pàgina a pàgina per PDFs, paths per imatges)"""
         try:
             if file_path.lower().endswith('.pdf'):
-                # Try to convert PDF to images
+                # Rasteritzar el PDF directament a memòria, sense PNG intermedis
                 try:
-                    from src.pdf_to_images import convert_pdf_to_images
-                    images_folder = str(self.project_root / 'data' / 'images')
-                    os.makedirs(images_folder, exist_ok=True)
-                    return convert_pdf_to_images(file_path, images_folder)
+                    from src.pdf_to_images import pdf_to_tensors
+                    return pdf_to_tensors(file_path)
                 except Exception as e:
                     logger.warning(f"PDF conversion failed: {e}")
                     return [file_path]
@@ -156,41 +163,50 @@ class DirectWebPipeline:
     
     def _format_technical_elements(self, detections: List[Dict]) -> List[Dict]:
         """Formatar elements tècnics trobats"""
-        elements = []
-        for detection in detections:
-            elements.append({
+        if not detections:
+            return []
+        
+        # Calcular totes les àrees d'una sola passada amb NumPy
+        bboxes = [detection.get('bbox', {}) for detection in detections]
+        bbox_wh = np.array(
+            [(bbox.get('width', 0), bbox.get('height', 0)) for bbox in bboxes],
+            dtype=np.float64
+        )
+        areas = bbox_wh.prod(axis=1).tolist()
+        
+        return [
+            {
                 'type': detection.get('type', 'unknown'),
                 'confidence': detection.get('confidence', 0),
-                'bbox': detection.get('bbox', {}),
+                'bbox': bbox,
                 'center': detection.get('center', {}),
                 'id': detection.get('id', 'unknown'),
-                'area': detection.get('bbox', {}).get('width', 0) * detection.get('bbox', {}).get('height', 0)
-            })
-        return elements
+                'area': area
+            }
+            for detection, bbox, area in zip(detections, bboxes, areas)
+        ]
     
     def _analyze_combined_results(self, result: Dict) -> Dict[str, Any]:
         """Analitzar resultats combinats"""
+        elements = result['technical_elements']
         analysis = {
-            'total_elements': len(result['technical_elements']),
-            'element_types': {},
+            'total_elements': len(elements),
+            'element_types': dict(Counter(element['type'] for element in elements)),
             'confidence_stats': {},
             'text_quality': 'unknown'
         }
         
-        # Count element types
-        for element in result['technical_elements']:
-            element_type = element['type']
-            if element_type not in analysis['element_types']:
-                analysis['element_types'][element_type] = 0
-            analysis['element_types'][element_type] += 1
-        
         # Calculate confidence statistics
-        if result['technical_elements']:
-            confidences = [e['confidence'] for e in result['technical_elements']]
+        if elements:
+            confidences = np.fromiter(
+                (element['confidence'] for element in elements),
+                dtype=np.float64,
+                count=len(elements)
+            )
             analysis['confidence_stats'] = {
-                'min': min(confidences),
-                'max': max(confidences),
-                'avg': sum(confidences) / len(confidences)
+                'min': float(confidences.min()),
+                'max': float(confidences.max()),
+                'avg': float(confidences.mean())
             }
         
         # Analyze text quality
@@ -218,12 +234,21 @@ class DirectWebPipeline:
             'combined_analysis': True
         }
 
+# Instància compartida: els pesos dels models es carreguen un sol cop per procés
+_PIPELINE: Optional[DirectWebPipeline] = None
+_PIPELINE_LOCK = threading.Lock()
+
 def create_direct_pipeline() -> Optional[DirectWebPipeline]:
-    """Factory function per crear pipeline directe"""
+    """Factory function per obtenir el pipeline directe compartit"""
+    global _PIPELINE
     try:
-        pipeline = DirectWebPipeline()
-        if pipeline.is_available():
-            return pipeline
+        if _PIPELINE is None:
+            with _PIPELINE_LOCK:
+                if _PIPELINE is None:
+                    _PIPELINE = DirectWebPipeline()
+        
+        if _PIPELINE.is_available():
+            return _PIPELINE
         else:
             logger.warning("No OCR/YOLOv8 components available")
             return None
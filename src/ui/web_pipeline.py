@@ -6,15 +6,91 @@ Combina OCR tradicional amb detecció YOLOv8
 
 import os
 import sys
+import functools
+import importlib
+import importlib.util
 import json
 import time
 import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Any, Optional
+from typing import Dict, Iterable, List, Any, Optional, Tuple
+
+import numpy as np
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# Candidate import paths, in order of preference
+_YOLO_MODULES = (
+    'src.technical_element_detector',
+    'technical_element_detector',
+    'production.technical_element_detector'
+)
+_OCR_MODULES = (
+    'src.ocr_processor',
+    'ocr_processor',
+    'production.ocr_processor'
+)
+_PDF_MODULES = (
+    'src.pdf_to_images',
+    'pdf_to_images',
+    'production.pdf_to_images'
+)
+
+@functools.lru_cache(maxsize=None)
+def _resolve_module(module_names: Tuple[str, ...], attribute: str):
+    """Importar el primer mòdul de la llista que defineixi l'atribut (resultat en memòria cau)"""
+    for module_name in module_names:
+        try:
+            if importlib.util.find_spec(module_name) is None:
+                continue
+            module = importlib.import_module(module_name)
+        except (ImportError, ValueError) as e:
+            logger.debug("Failed to import from %s: %s", module_name, e)
+            continue
+        if hasattr(module, attribute):
+            return module
+        logger.debug("Module %s has no attribute %s", module_name, attribute)
+    return None
+
+# Tesseract runs outside the GIL, so a few threads overlap pages; the pool is shared by
+# every request in the process so concurrent requests cannot oversubscribe the CPU
+_OCR_MAX_WORKERS = min(4, os.cpu_count() or 1)
+
+# Pages sent to the detector per batched YOLOv8 call
+_YOLO_BATCH_SIZE = 8
+
+@functools.lru_cache(maxsize=1)
+def _ocr_executor() -> ThreadPoolExecutor:
+    """Pool de fils per l'OCR compartit per tot el procés"""
+    return ThreadPoolExecutor(max_workers=_OCR_MAX_WORKERS, thread_name_prefix='ocr')
+
+@functools.lru_cache(maxsize=1)
+def _load_yolo():
+    """Carregar el detector YOLOv8 un sol cop per procés (None si no està disponible)"""
+    module = _resolve_module(_YOLO_MODULES, 'TechnicalElementDetector')
+    if module is None:
+        logger.warning("YOLOv8 detector not available from any source")
+        return None
+    
+    detector = module.TechnicalElementDetector()
+    logger.info("YOLOv8 detector initialized successfully from %s", module.__name__)
+    return detector
+
+@functools.lru_cache(maxsize=1)
+def _load_ocr():
+    """Carregar el processador OCR un sol cop per procés (None si no està disponible)"""
+    module = _resolve_module(_OCR_MODULES, 'OCRProcessor')
+    if module is None:
+        logger.warning("OCR processor not available from any source")
+        return None
+    
+    processor = module.OCRProcessor()
+    logger.info("OCR processor initialized successfully from %s", module.__name__)
+    return processor
+
 class WebOCRPipeline:
     """Pipeline OCR optimitzat per la interfície web"""
     
@@ -36,54 +112,12 @@ class WebOCRPipeline:
                 sys.path.insert(0, path)
         
         try:
-            # Try different import paths for YOLOv8 detector
-            self.yolo_detector = None
-            import_attempts = [
-                'src.technical_element_detector',
-                'technical_element_detector',
-                'production.technical_element_detector'
-            ]
-            
-            for module_name in import_attempts:
-                try:
-                    module = __import__(module_name, fromlist=['TechnicalElementDetector'])
-                    TechnicalElementDetector = getattr(module, 'TechnicalElementDetector')
-                    self.yolo_detector = TechnicalElementDetector()
-                    logger.info(f"YOLOv8 detector initialized successfully from {module_name}")
-                    break
-                except (ImportError, AttributeError) as e:
-                    logger.debug(f"Failed to import from {module_name}: {e}")
-                    continue
-            
-            if not self.yolo_detector:
-                logger.warning("YOLOv8 detector not available from any source")
-                
+            self.yolo_detector = _load_yolo()
         except Exception as e:
             logger.warning(f"YOLOv8 detector setup failed: {e}")
         
         try:
-            # Try different import paths for OCR processor
-            self.ocr_processor = None
-            import_attempts = [
-                'src.ocr_processor',
-                'ocr_processor',
-                'production.ocr_processor'
-            ]
-            
-            for module_name in import_attempts:
-                try:
-                    module = __import__(module_name, fromlist=['OCRProcessor'])
-                    OCRProcessor = getattr(module, 'OCRProcessor')
-                    self.ocr_processor = OCRProcessor()
-                    logger.info(f"OCR processor initialized successfully from {module_name}")
-                    break
-                except (ImportError, AttributeError) as e:
-                    logger.debug(f"Failed to import from {module_name}: {e}")
-                    continue
-            
-            if not self.ocr_processor:
-                logger.warning("OCR processor not available from any source")
-                
+            self.ocr_processor = _load_ocr()
         except Exception as e:
             logger.warning(f"OCR processor setup failed: {e}")
     
@@ -117,25 +151,54 @@ class WebOCRPipeline:
             # Convert PDF to image if needed
             image_paths = self._prepare_images(file_path)
             
-            all_text = []
-            all_confidences = []
+            text_parts = []
+            sum_conf = 0.0
+            n_conf = 0
             all_detections = []
             
+            # Batched YOLOv8 inference when the detector supports it
+            batch_yolo = hasattr(self.yolo_detector, 'detect_elements_batch')
+            yolo_pages = []
+            
+            executor = _ocr_executor()
+            ocr_futures = []
+            
+            # Pages are rendered one at a time on this thread (image_paths is a
+            # generator), so OCR of page k on the pool overlaps rendering of page k+1
             for image_path in image_paths:
-                # Process with OCR
+                # Process with OCR: tesseract releases the GIL, so pages run in parallel
                 if self.ocr_processor:
-                    ocr_result = self._process_ocr(image_path, options)
-                    all_text.append(ocr_result.get('text', ''))
-                    all_confidences.append(ocr_result.get('confidence', 0))
+                    ocr_futures.append(executor.submit(self._process_ocr, image_path, options))
                 
-                # Process with YOLOv8
+                # Process with YOLOv8 on this thread: the next page is only rendered once it returns
                 if self.yolo_detector:
-                    yolo_result = self._process_yolo(image_path, options)
-                    all_detections.extend(yolo_result.get('detections', []))
+                    if batch_yolo:
+                        yolo_pages.append(image_path)
+                        # Flush a full batch now instead of waiting for every page
+                        if len(yolo_pages) == _YOLO_BATCH_SIZE:
+                            yolo_result = self._process_yolo_batch(yolo_pages, options)
+                            all_detections.extend(yolo_result.get('detections', []))
+                            yolo_pages = []
+                    else:
+                        yolo_result = self._process_yolo(image_path, options)
+                        all_detections.extend(yolo_result.get('detections', []))
+            
+            if yolo_pages:
+                yolo_result = self._process_yolo_batch(yolo_pages, options)
+                all_detections.extend(yolo_result.get('detections', []))
+            
+            # Collect OCR results in page order
+            for future in ocr_futures:
+                ocr_result = future.result()
+                page_text = ocr_result.get('text', '')
+                if page_text:
+                    text_parts.append(page_text)
+                sum_conf += ocr_result.get('confidence', 0)
+                n_conf += 1
             
             # Combine results
-            result['ocr_text'] = '\n\n'.join(filter(None, all_text))
-            result['ocr_confidence'] = sum(all_confidences) / len(all_confidences) if all_confidences else 0
+            result['ocr_text'] = '\n\n'.join(text_parts)
+            result['ocr_confidence'] = sum_conf / n_conf if n_conf else 0
             result['yolo_detections'] = all_detections
             result['technical_elements'] = self._format_technical_elements(all_detections)
             result['combined_analysis'] = self._analyze_combined_results(result)
@@ -148,25 +211,16 @@ class WebOCRPipeline:
         
         return result
     
-    def _prepare_images(self, file_path: str) -> List[str]:
-        """Preparar imatges per processar"""
+    def _prepare_images(self, file_path: str) -> Iterable[str]:
+        """Preparar imatges per processar (les pàgines dels PDFs es generen d'una en una)"""
         try:
             if file_path.lower().endswith('.pdf'):
-                # Try different import paths for PDF conversion
-                import_attempts = [
-                    'src.pdf_to_images',
-                    'pdf_to_images',
-                    'production.pdf_to_images'
-                ]
-                
-                for module_name in import_attempts:
-                    try:
-                        module = __import__(module_name, fromlist=['convert_pdf_to_images'])
-                        convert_pdf_to_images = getattr(module, 'convert_pdf_to_images')
-                        return convert_pdf_to_images(file_path)
-                    except (ImportError, AttributeError) as e:
-                        logger.debug(f"Failed to import PDF converter from {module_name}: {e}")
-                        continue
+                module = _resolve_module(_PDF_MODULES, 'iter_pdf_pages')
+                if module is not None:
+                    return module.iter_pdf_pages(file_path)
+                module = _resolve_module(_PDF_MODULES, 'convert_pdf_to_images')
+                if module is not None:
+                    return module.convert_pdf_to_images(file_path)
                 
                 # If all imports fail, return original path
                 logger.warning("PDF to images conversion not available")
@@ -200,14 +254,41 @@ class WebOCRPipeline:
             
             detections = self.yolo_detector.detect_elements(
                 image_path,
-                confidence_threshold=confidence_threshold
+                conf=confidence_threshold
             )
             
-            return {'detections': detections}
+            if 'error' in detections:
+                logger.error("YOLOv8 processing error for %s: %s", image_path, detections['error'])
+                return {'detections': [], 'error': detections['error']}
+            return {'detections': detections.get('elements', [])}
         except Exception as e:
             logger.error(f"YOLOv8 processing error: {e}")
             return {'detections': [], 'error': str(e)}
     
+    def _process_yolo_batch(self, image_paths: List[str], options: Dict) -> Dict[str, Any]:
+        """Processar diverses imatges amb YOLOv8 en una sola crida per lots"""
+        try:
+            confidence_threshold = options.get('yolo_confidence', 0.3)
+            
+            page_results = self.yolo_detector.detect_elements_batch(
+                image_paths,
+                batch_size=min(_YOLO_BATCH_SIZE, len(image_paths)),
+                conf=confidence_threshold
+            )
+            
+            detections = []
+            for image_path, page_result in zip(image_paths, page_results):
+                if 'error' in page_result:
+                    # A failed batch reports the error on every page: retry this page alone
+                    logger.warning("YOLOv8 batch failed for %s (%s), retrying page alone",
+                                   image_path, page_result['error'])
+                    page_result = {'elements': self._process_yolo(image_path, options).get('detections', [])}
+                detections.extend(page_result.get('elements', []))
+            return {'detections': detections}
+        except Exception as e:
+            logger.error(f"YOLOv8 batch processing error: {e}")
+            return {'detections': [], 'error': str(e)}
+    
     def _format_technical_elements(self, detections: List[Dict]) -> List[Dict]:
         """Formatar elements tècnics trobats"""
         elements = []
@@ -223,27 +304,25 @@ class WebOCRPipeline:
     
     def _analyze_combined_results(self, result: Dict) -> Dict[str, Any]:
         """Analitzar resultats combinats"""
+        elements = result['technical_elements']
         analysis = {
-            'total_elements': len(result['technical_elements']),
-            'element_types': {},
+            'total_elements': len(elements),
+            'element_types': dict(Counter(element['type'] for element in elements)),
             'confidence_stats': {},
             'text_quality': 'unknown'
         }
         
-        # Count element types
-        for element in result['technical_elements']:
-            element_type = element['type']
-            if element_type not in analysis['element_types']:
-                analysis['element_types'][element_type] = 0
-            analysis['element_types'][element_type] += 1
-        
         # Calculate confidence statistics
-        if result['technical_elements']:
-            confidences = [e['confidence'] for e in result['technical_elements']]
+        if elements:
+            confidences = np.fromiter(
+                (element['confidence'] for element in elements),
+                dtype=np.float64,
+                count=len(elements)
+            )
             analysis['confidence_stats'] = {
-                'min': min(confidences),
-                'max': max(confidences),
-                'avg': sum(confidences) / len(confidences)
+                'min': float(confidences.min()),
+                'max': float(confidences.max()),
+                'avg': float(confidences.mean())
             }
         
         # Analyze text quality